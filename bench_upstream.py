@@ -0,0 +1,102 @@
+"""Benchmark for the upstream encodings in send_to_api.py.
+
+It starts a local stub HTTP server, parses the example Codec 8 packet from client.py and
+ forwards its records with every combination of batch format and content encoding.
+For each mode it prints, per record:
+  - body bytes: the HTTP request bodies only
+  - request bytes: everything the stub receives, i.e. request line + headers + body, so the
+    per-request HTTP overhead of one POST per record vs one POST per packet is included
+  - CPU time of the forwarding thread only (encoding + POST); the stub server runs on its own
+    thread and is not counted
+
+Usage: python bench_upstream.py [iterations]"""
+
+import contextlib
+import io
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import send_to_api
+from parser import parse_avl_packet
+
+# 10 record Codec 8 packet (same as the commented example in client.py)
+EXAMPLE_PACKET = bytes.fromhex('000000000000048B080A0000019208F0A690002B8B350614052A61020200690E000700200EEF01F0011502450171641E001F322053210125002600273F291F325A10B5000BB60007423546180005CD2E37CE507C430FC124038B2801242A01132B0000310984333519340018360000371E7802F10000A029100001BBC9000000019208F0C1E8002B8B325B14052B3A020101260E000600200EEF01F0011502450171641E001F35205321032507260F273F291F325A10B5000AB6000742355D180005CD2E37CE507C430FC12404F02801282A011A2B0000310984333554340012360000371E7802F10000A029100001BBD0000000019208F0E8F8002B8B2F2A14052D81020001160E000000200EEF01F0011502450171641E001F4D2053210725002613273F2922325A10B5000BB6000742355A180000CD2E37CE507C430FC12406582801FE2A01242B0000310984333554340010360000371E7802F10000A029100001BBD9000000019208F10C20002B8B2E2014052FC901FE01640E000A00200EEF01F0011502450171641E001F33205221052504260F273F291F325A10B50010B60007423555180008CD2E37CE507C430FC12403152801542A012C2B00003109843334F234001F360000371E7902F10000A029100001BBE1000000019208F13330002B8B2C6E1405324201FC015A0E000000200EEF01F0011502450171641E001F3120532100250026042740291F325A10B5000AB60007423534180000CD2E37CE507C430FC12403A42801212A01362B000031098433352D340017360000371E7902F10000A029100001BBE8000000019208F15A40002B8B295F140534AB01FA014D0E000500200EEF01F0011502450171641E001F3820532100250626FC2740291F325A10B5000BB60007423502180004CD2E37CE507C430FC12403C028011A2A01402B0000310984333519340016360000371E7902F10000A029100001BBF5000000019208F18150002B8B28121405353001FA01560E000000200EEF01F0011502450171641E001F46205321FF2500261027402922325A10B5000FB6000742353A180000CD2E37CE507C430FC12406E02802FF2A01492B0000310984333519340019360000371E7902F10000A029100001BBF5000000019208F19CA8002B8B24C0140537CB01FA01180E000A00200EEF01F0011502450171641E001F4E20532103250A2608273F2924325A10B50010B60007423550180008CD2E37CE507C430FC12403822802A32A01502B000031098433351934003C360000371E7902F10000A029100001BC03000000019208F1AC48002B8B1F261405352001FB00DC0E001100200EEF01F0011502450171641E001F60205321FE25102601273F2929325A10B50010B6000742354F180011CD2E37CE507C430FC12405782804362A01542B000031098433352D34003D360000371E7902F10000A029100001BC14000000019208F1D358002B8B1D6414051CC601FA00C30E001D00200EEF01F0011503450171641E001F492053210025202612273E2926325A10B50010B6000742355A18001DCD2E37CE507C430FC124068028033D2A015E2B000031098433354034002B360000371E7902F10000A029100001BC5A000A00008981')
+DEVICE_ID = '356307042441013'
+
+# Bytes received by the stub server since the last reset
+received_body_bytes = 0
+received_request_bytes = 0
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        global received_body_bytes, received_request_bytes
+        length = int(self.headers.get('Content-Length', 0))
+        body_bytes = len(self.rfile.read(length))
+        # Request line + "Name: value\r\n" per header + the blank line ending the headers
+        header_bytes = len(self.raw_requestline) + 2 + sum(
+            len(name) + len(value) + 4 for name, value in self.headers.items())
+        received_body_bytes += body_bytes
+        received_request_bytes += header_bytes + body_bytes
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, format, *args):
+        pass
+
+def run_mode(batch_format, content_encoding, records, iterations):
+    global received_body_bytes, received_request_bytes
+    send_to_api.UPSTREAM_BATCH_FORMAT = batch_format
+    send_to_api.UPSTREAM_CONTENT_ENCODING = content_encoding
+    send_to_api.upstream_fallback_until = 0.0
+    received_body_bytes = 0
+    received_request_bytes = 0
+
+    cpu_start = time.thread_time()
+    # send_to_api prints one line per request, keep the benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(iterations):
+            batch = [dict(record) for record in records]
+            if send_to_api.upstream_batching_enabled():
+                send_to_api.send_batch_to_api(DEVICE_ID, batch)
+            else:
+                for record in batch:
+                    send_to_api.send_data_to_api(DEVICE_ID, [record])
+    cpu_used = time.thread_time() - cpu_start
+
+    total_records = iterations * len(records)
+    return (received_body_bytes / total_records, received_request_bytes / total_records,
+            cpu_used / total_records * 1e6)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    server = HTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    send_to_api.API_URL = f'http://127.0.0.1:{server.server_port}/receive-data'
+
+    parsed_data, num_of_data, _ = parse_avl_packet(EXAMPLE_PACKET)
+    records = [{k: v for k, v in record.items() if k != 'end_position'} for record in parsed_data]
+    codec8_bytes = len(EXAMPLE_PACKET) / num_of_data
+
+    modes = [('json', ''), ('json', 'gzip'), ('columnar', ''), ('columnar', 'gzip')]
+    if send_to_api.zstandard is not None:
+        modes += [('json', 'zstd'), ('columnar', 'zstd')]
+
+    print(f'Codec 8 input: {codec8_bytes:.1f} bytes/record, {num_of_data} records/packet, {iterations} iterations')
+    print(f'{"format":<10} {"encoding":<9} {"body B/record":>14} {"request B/record":>17} {"cpu us/record":>14}')
+    for batch_format, content_encoding in modes:
+        body_per_record, request_per_record, cpu_per_record = run_mode(
+            batch_format, content_encoding, records, iterations)
+        label = 'per-record' if not send_to_api.upstream_batching_enabled() else batch_format
+        print(f'{label:<10} {content_encoding or "-":<9} {body_per_record:>14.1f} '
+              f'{request_per_record:>17.1f} {cpu_per_record:>14.1f}')
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@ in the packet (in case there's more to parse)."""
 import struct
 import time
 from io_id_mapping import *
+from profiling import mark_stage
 
 def parse_avl_packet(packet):
     index = 0
@@ -45,6 +46,8 @@ def parse_avl_packet(packet):
         # Parse the number of data records (next 1 byte)
         num_of_data_1 = packet[index]
         index += 1
+        # End of the frame header (preamble, data length, codec ID, number of data), for tracing
+        mark_stage('frame')
 
         for record_num in range(num_of_data_1):
             # Process each AVL record
@@ -0,0 +1,236 @@
+"""On-demand profiling and per-stage latency tracing for the TCP server.
+
+Sampling profiler: sending SIGUSR1 to the server, or the command "profile [seconds]" to the
+ admin socket, samples the stacks of all threads every few milliseconds for N seconds and writes
+ them in collapsed-stack format (one "frame;frame;frame count" line per stack), which can be fed
+ directly to flamegraph.pl or opened in speedscope.
+
+Trace spans: a sampled fraction of the received AVL frames is timed stage by stage
+ (receive -> frame -> parse -> serialize -> forward -> ack). Each sampled trace is logged and added
+ to the per-stage totals returned by the admin command "stats". With a sample rate of 0 (the
+ default) mark_stage() only checks a global and returns.
+
+Configuration (environment variables):
+  PROFILE_SECONDS    default duration for SIGUSR1 / "profile" (10, at most 600)
+  PROFILE_DIR        directory for the collapsed-stack files (current directory)
+  TRACE_SAMPLE_RATE  fraction of frames to trace, 0.0 - 1.0 (0)
+  ADMIN_PORT         port of the admin socket on 127.0.0.1, 0 disables it (0)"""
+
+import os
+import math
+import sys
+import time
+import random
+import signal
+import socket
+import logging
+import threading
+from collections import Counter
+
+PROFILE_SECONDS = float(os.environ.get('PROFILE_SECONDS', 10))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '.')
+PROFILE_INTERVAL = 0.005  # Seconds between two stack samples
+PROFILE_MAX_SECONDS = 600  # Upper limit for one profiling run
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+ADMIN_PORT = int(os.environ.get('ADMIN_PORT', 0))
+
+# Stage order used when logging traces and printing stats
+TRACE_STAGES = ('receive', 'frame', 'parse', 'serialize', 'forward', 'ack')
+
+"""This class holds the timings of one traced AVL frame. Each stage accumulates the time since the
+ previous mark, so a stage that runs several times (one POST per record) is summed."""
+
+class Trace:
+    def __init__(self, imei, start=None):
+        self.imei = imei
+        self.start = time.perf_counter() if start is None else start
+        self.last = self.start
+        self.stages = {}
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self.last)
+        self.last = now
+
+# Trace of the frame currently being processed (the server handles one connection at a time)
+current_trace = None
+
+# Per-stage aggregates of all finished traces: stage -> [count, total seconds, max seconds]
+trace_stats = {}
+trace_lock = threading.Lock()
+
+# Profiler state, only one profiling run at a time. start_profiling() can be reached from
+# the signal handler and the admin thread, so the check and the start happen under the lock.
+profiler_thread = None
+profiler_lock = threading.Lock()
+
+def wait_for_data(connection):
+    """When tracing, block until the device sends data and return the time it arrived, so that
+    the receive stage covers reading the data and not the idle wait before it."""
+    if TRACE_SAMPLE_RATE <= 0:
+        return None
+    connection.recv(1, socket.MSG_PEEK)
+    return time.perf_counter()
+
+def begin_trace(imei, receive_start=None):
+    # receive_start is only passed for the first frame of a recv() buffer
+    global current_trace
+    if TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE:
+        current_trace = Trace(imei, receive_start)
+        if receive_start is not None:
+            current_trace.mark('receive')
+    else:
+        current_trace = None
+
+def mark_stage(stage):
+    if current_trace is not None:
+        current_trace.mark(stage)
+
+def end_trace():
+    global current_trace
+    trace = current_trace
+    if trace is None:
+        return
+    current_trace = None
+
+    total = trace.last - trace.start
+    with trace_lock:
+        for stage, seconds in list(trace.stages.items()) + [('total', total)]:
+            stats = trace_stats.setdefault(stage, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    stages = ' '.join(f'{stage}={trace.stages[stage] * 1000:.2f}ms'
+                      for stage in TRACE_STAGES if stage in trace.stages)
+    logging.info(f"Trace {trace.imei}: {stages} total={total * 1000:.2f}ms")
+
+def format_trace_stats():
+    with trace_lock:
+        if not trace_stats:
+            return f"No traces recorded (sample rate {TRACE_SAMPLE_RATE})\n"
+        lines = [f"{'stage':<10} {'count':>7} {'avg ms':>9} {'max ms':>9}"]
+        for stage in TRACE_STAGES + ('total',):
+            if stage in trace_stats:
+                count, total, maximum = trace_stats[stage]
+                lines.append(f"{stage:<10} {count:>7} {total / count * 1000:>9.3f} {maximum * 1000:>9.3f}")
+    return '\n'.join(lines) + '\n'
+
+def set_trace_sample_rate(rate):
+    global TRACE_SAMPLE_RATE
+    if not math.isfinite(rate):
+        raise ValueError(f"sample rate must be a number between 0 and 1, got {rate}")
+    TRACE_SAMPLE_RATE = min(max(rate, 0.0), 1.0)
+
+def collapse_stack(frame):
+    # Walk from the innermost frame to the outermost, then reverse to get root;...;leaf
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def run_profiler(seconds, output_path):
+    own_id = threading.get_ident()
+    thread_names = {}
+    samples = Counter()
+    end_time = time.monotonic() + seconds
+
+    while time.monotonic() < end_time:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            if thread_id not in thread_names:
+                thread_names = {t.ident: t.name for t in threading.enumerate()}
+            thread_name = thread_names.get(thread_id, str(thread_id))
+            samples[f"{thread_name};{collapse_stack(frame)}"] += 1
+        time.sleep(PROFILE_INTERVAL)
+
+    with open(output_path, 'w') as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+    logging.info(f"Profile written to {output_path} ({sum(samples.values())} samples)")
+
+def start_profiling(seconds=None):
+    """Start a background sampling run. Returns the output path, or None if one is already running.
+    Raises ValueError unless 0 < seconds <= PROFILE_MAX_SECONDS."""
+    global profiler_thread
+    seconds = PROFILE_SECONDS if seconds is None else seconds
+    if not (math.isfinite(seconds) and 0 < seconds <= PROFILE_MAX_SECONDS):
+        raise ValueError(f"duration must be between 0 and {PROFILE_MAX_SECONDS} seconds, got {seconds}")
+
+    # Non-blocking so a signal arriving while the main thread holds the lock cannot deadlock
+    if not profiler_lock.acquire(blocking=False):
+        return None
+    try:
+        if profiler_thread is not None and profiler_thread.is_alive():
+            return None
+
+        output_path = os.path.join(PROFILE_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.collapsed")
+        profiler_thread = threading.Thread(target=run_profiler, args=(seconds, output_path),
+                                           name='profiler', daemon=True)
+        profiler_thread.start()
+    finally:
+        profiler_lock.release()
+
+    logging.info(f"Profiling for {seconds} seconds, writing to {output_path}")
+    return output_path
+
+def handle_admin_command(line):
+    parts = line.split()
+    if not parts:
+        return "Commands: profile [seconds], trace <rate>, stats\n"
+
+    command = parts[0].lower()
+    try:
+        if command == 'profile':
+            output_path = start_profiling(float(parts[1]) if len(parts) > 1 else None)
+            if output_path is None:
+                return "Profiling already running\n"
+            return f"Profiling, writing to {output_path}\n"
+        if command == 'trace' and len(parts) > 1:
+            set_trace_sample_rate(float(parts[1]))
+            return f"Trace sample rate set to {TRACE_SAMPLE_RATE}\n"
+        if command == 'stats':
+            return format_trace_stats()
+    except ValueError as e:
+        return f"Invalid argument: {e}\n"
+    return f"Unknown command: {line.strip()}\n"
+
+def serve_admin(admin_socket):
+    while True:
+        try:
+            connection, client_address = admin_socket.accept()
+            with connection:
+                data = connection.recv(1024)
+                if data:
+                    reply = handle_admin_command(data.decode('ascii', errors='replace'))
+                    connection.sendall(reply.encode('ascii'))
+        except Exception as e:
+            logging.error(f"Admin socket error: {e}")
+
+def start_admin_server(port=None, host='127.0.0.1'):
+    port = ADMIN_PORT if port is None else port
+    admin_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    admin_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    admin_socket.bind((host, port))
+    admin_socket.listen(1)
+    threading.Thread(target=serve_admin, args=(admin_socket,), name='admin', daemon=True).start()
+    logging.info(f"Started admin socket on {host}:{admin_socket.getsockname()[1]}")
+    return admin_socket
+
+def handle_profile_signal(signum, frame):
+    try:
+        if start_profiling() is None:
+            logging.info("Profiling already running, ignoring signal")
+    except ValueError as e:
+        logging.error(f"Cannot start profiling: {e}")
+
+def install_profiling_hooks():
+    # SIGUSR1 -> profile for PROFILE_SECONDS (not available on Windows, and handlers
+    # can only be installed from the main thread)
+    if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, handle_profile_signal)
+    if ADMIN_PORT:
+        start_admin_server()
@@ -1,28 +1,91 @@
 import requests
 import json
+import gzip
+import os
+import time
+import logging
 from datetime import datetime, timezone
+from profiling import mark_stage
 
-def send_data_to_api(device_id, parsed_data):
-    # Helper function to calculate rtp value
-    def get_rtp(timestamp):
-        try:
-            # Convert the timestamp from the payload to a timezone-aware datetime object
-            payload_time = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-            payload_time = payload_time.replace(tzinfo=timezone.utc)  # Make it UTC aware
-        except ValueError:
-            # Handle incorrect timestamp format
-            return 0
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+# Module logger: logging from here at import time must not configure the root logger before tcp.py does
+logger = logging.getLogger(__name__)
+
+# Define your API endpoint
+API_URL = "http://20.174.9.78:8000/receive-data"
+
+# Opt-in upstream encoding. With the defaults every record is posted as plain JSON.
+# UPSTREAM_CONTENT_ENCODING: '' (none), 'gzip' or 'zstd'
+# UPSTREAM_BATCH_FORMAT: 'json' (list of records) or 'columnar' (per-batch key dictionary)
+UPSTREAM_CONTENT_ENCODING = os.environ.get('UPSTREAM_CONTENT_ENCODING', '').strip().lower()
+UPSTREAM_BATCH_FORMAT = os.environ.get('UPSTREAM_BATCH_FORMAT', 'json').strip().lower()
+
+# Check the settings once here, a bad value must not fail every packet later on
+if UPSTREAM_CONTENT_ENCODING not in ('', 'gzip', 'zstd'):
+    logger.error(f"Unknown UPSTREAM_CONTENT_ENCODING {UPSTREAM_CONTENT_ENCODING!r}, sending uncompressed")
+    UPSTREAM_CONTENT_ENCODING = ''
+elif UPSTREAM_CONTENT_ENCODING == 'zstd' and zstandard is None:
+    logger.error("UPSTREAM_CONTENT_ENCODING is zstd but the zstandard package is not installed, sending uncompressed")
+    UPSTREAM_CONTENT_ENCODING = ''
+if UPSTREAM_BATCH_FORMAT not in ('json', 'columnar'):
+    logger.error(f"Unknown UPSTREAM_BATCH_FORMAT {UPSTREAM_BATCH_FORMAT!r}, using plain JSON")
+    UPSTREAM_BATCH_FORMAT = 'json'
+
+# When the API says it does not support the batch encoding/format we send plain JSON for
+# UPSTREAM_RETRY_SECONDS and then try batching again, so one rejection is not permanent
+UPSTREAM_RETRY_SECONDS = float(os.environ.get('UPSTREAM_RETRY_SECONDS', 300))
+
+# Status codes that mean the API does not support the batch encoding/format. 415 says so
+# directly; the others can also be caused by the data, so they only count if the same records
+# then go through as plain JSON.
+UNSUPPORTED_STATUS = 415
+MAYBE_UNSUPPORTED_STATUSES = (400, 404, 422, 501)
+
+# time.monotonic() until which batching is off, 0 when batching is on
+upstream_fallback_until = 0.0
 
-        # Get the current time as an aware datetime
-        current_time = datetime.now(timezone.utc)
+# Helper function to calculate rtp value
+def get_rtp(timestamp):
+    try:
+        # Convert the timestamp from the payload to a timezone-aware datetime object
+        payload_time = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+        payload_time = payload_time.replace(tzinfo=timezone.utc)  # Make it UTC aware
+    except ValueError:
+        # Handle incorrect timestamp format
+        return 0
 
-        # Calculate the time difference in seconds
-        time_diff = (current_time - payload_time).total_seconds()
-        # Determine the rtp value based on the time difference
-        return 1 if time_diff <= 60 else 0
+    # Get the current time as an aware datetime
+    current_time = datetime.now(timezone.utc)
+
+    # Calculate the time difference in seconds
+    time_diff = (current_time - payload_time).total_seconds()
+    # Determine the rtp value based on the time difference
+    return 1 if time_diff <= 60 else 0
+
+def upstream_batching_enabled():
+    return time.monotonic() >= upstream_fallback_until and (
+        bool(UPSTREAM_CONTENT_ENCODING) or UPSTREAM_BATCH_FORMAT != 'json')
+
+def fall_back_to_plain_json(response, headers):
+    global upstream_fallback_until
+    upstream_fallback_until = time.monotonic() + UPSTREAM_RETRY_SECONDS
+    # A 415 may list the encodings the API does accept (RFC 7694)
+    accepted = response.headers.get('Accept-Encoding')
+    logger.warning(f"API does not support {headers} (status code {response.status_code}"
+                   f"{', Accept-Encoding: ' + accepted if accepted else ''}), "
+                   f"sending plain JSON for {UPSTREAM_RETRY_SECONDS:.0f} seconds")
+
+def send_data_to_api(device_id, parsed_data):
+    # Returns True only if every record was accepted by the API
+    sent_all = False
 
     # Check if parsed_data is a list and contains at least one record
     if parsed_data and isinstance(parsed_data, list) and len(parsed_data) > 0:
+        sent_all = True
         # Iterate through each record
         for record in parsed_data:
             # Ensure that the required fields exist
@@ -38,22 +101,26 @@ def send_data_to_api(device_id, parsed_data):
 
             # Convert the payload into JSON format
             payload_json = json.dumps(payload)
-
-            # Define your API endpoint
-            url = "http://20.174.9.78:8000/receive-data"
+            mark_stage('serialize')
 
             try:
                 # Send a POST request to your API with the JSON payload
-                response = requests.post(url, data=payload_json, headers={'Content-Type': 'application/json'})
+                try:
+                    response = requests.post(API_URL, data=payload_json, headers={'Content-Type': 'application/json'})
+                finally:
+                    # Count the time blocked on the API even if the POST fails
+                    mark_stage('forward')
 
                 # Check the response
                 if response.status_code == 200:
                     print(f"Data sent successfully to the API for Device {device_id}: {payload_json}")
                 else:
                     print(f"Failed to send data, Status code: {response.status_code}, Response: {response.text}")
+                    sent_all = False
 
             except requests.exceptions.RequestException as e:
                 print(f"An error occurred while sending data to the API: {e}")
+                sent_all = False
 
     else:
         # Handle case where parsed_data is empty or not a list
@@ -65,12 +132,9 @@ def send_data_to_api(device_id, parsed_data):
         # Convert the payload into JSON format
         payload_json = json.dumps(payload)
 
-        # Define your API endpoint
-        url = "http://20.174.9.78:8000/receive-data"
-
         try:
             # Send a POST request to your API with the JSON payload
-            response = requests.post(url, data=payload_json, headers={'Content-Type': 'application/json'})
+            response = requests.post(API_URL, data=payload_json, headers={'Content-Type': 'application/json'})
 
             # Check the response
             if response.status_code == 200:
@@ -80,3 +144,103 @@ def send_data_to_api(device_id, parsed_data):
 
         except requests.exceptions.RequestException as e:
             print(f"An error occurred while sending error message to the API: {e}")
+
+    return sent_all
+
+"""Batch encoding. A columnar batch lists each key once per batch instead of once per
+ record, which removes the long IO property names from IO_ID_MAPPING from every record:
+   {"DeviceID": ..., "format": "columnar-v1", "count": N,
+    "keys": ["T", "long", ...], "columns": [[T0, T1, ...], [long0, long1, ...], ...]}
+ A record that lacks a key holds null in that column."""
+
+def encode_columnar_batch(device_id, records):
+    keys = []
+    seen = set()
+    for record in records:
+        for key in record:
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+
+    return {
+        'DeviceID': device_id,
+        'format': 'columnar-v1',
+        'count': len(records),
+        'keys': keys,
+        'columns': [[record.get(key) for record in records] for key in keys]
+    }
+
+def encode_batch(device_id, records, batch_format='json', content_encoding=''):
+    """Return (body, headers) for a batch of records."""
+    if batch_format == 'columnar':
+        payload = encode_columnar_batch(device_id, records)
+        content_type = 'application/vnd.codec8.columnar+json'
+    else:
+        payload = [{'DeviceID': device_id, **record} for record in records]
+        content_type = 'application/json'
+
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    headers = {'Content-Type': content_type}
+
+    if content_encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+    elif content_encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd encoding requested but the zstandard package is not installed")
+        body = zstandard.ZstdCompressor(level=3).compress(body)
+        headers['Content-Encoding'] = 'zstd'
+    elif content_encoding:
+        raise ValueError(f"Unsupported content encoding: {content_encoding}")
+
+    return body, headers
+
+def send_batch_to_api(device_id, parsed_data):
+    global upstream_fallback_until
+
+    if not parsed_data or not isinstance(parsed_data, list) or not upstream_batching_enabled():
+        # Nothing to batch, or the API does not accept batches: use the plain JSON path
+        send_data_to_api(device_id, parsed_data)
+        return
+
+    for record in parsed_data:
+        timestamp = record.get('T')
+        record['rtp'] = get_rtp(timestamp) if timestamp else 0
+
+    try:
+        body, headers = encode_batch(device_id, parsed_data,
+                                     UPSTREAM_BATCH_FORMAT, UPSTREAM_CONTENT_ENCODING)
+    except Exception as e:
+        # Never let an encoding problem stop the ACK, send the records the plain way instead
+        logger.error(f"Failed to encode batch, sending plain JSON: {e}")
+        send_data_to_api(device_id, parsed_data)
+        return
+    mark_stage('serialize')
+
+    try:
+        try:
+            response = requests.post(API_URL, data=body, headers=headers)
+        finally:
+            # Count the time blocked on the API even if the POST fails
+            mark_stage('forward')
+
+        if 200 <= response.status_code < 300:
+            print(f"Batch of {len(parsed_data)} records sent successfully to the API for Device {device_id} ({len(body)} bytes)")
+            if upstream_fallback_until:
+                logger.info(f"API accepted {headers} again, batching resumed")
+                upstream_fallback_until = 0.0
+            return
+
+        # The packet is ACKed to the device after this returns, so a rejected batch is always
+        # resent record by record. Only an "unsupported" answer switches batching off for a while;
+        # 429, 5xx and anything else (413, ...) are treated as transient and keep the mode.
+        print(f"Failed to send batch, Status code: {response.status_code}, Response: {response.text}, resending as plain JSON")
+        sent_plain = send_data_to_api(device_id, parsed_data)
+        if response.status_code == UNSUPPORTED_STATUS or (
+                response.status_code in MAYBE_UNSUPPORTED_STATUSES and sent_plain):
+            fall_back_to_plain_json(response, headers)
+
+    except requests.exceptions.RequestException as e:
+        # Network problem, not a negotiation result: resend without changing the mode
+        print(f"An error occurred while sending batch to the API: {e}, resending as plain JSON")
+        send_data_to_api(device_id, parsed_data)
@@ -9,6 +9,7 @@ import struct
 import logging
 from parser import *
 from send_to_api import *
+from profiling import *
 
 logging.basicConfig(level=logging.INFO)
 
@@ -39,6 +40,9 @@ def start_tcp_server(host='0.0.0.0', port=9025):
 
     logging.info(f'Started TCP server on {host}:{port}')
 
+    # SIGUSR1 / admin socket profiling and per-stage tracing (see profiling.py)
+    install_profiling_hooks()
+
     while True:
         try:
             connection, client_address = server_socket.accept()
@@ -75,6 +79,8 @@ def start_tcp_server(host='0.0.0.0', port=9025):
 
                 while True:
                     try:
+                        # Only waits (MSG_PEEK) when tracing, so receive excludes the idle time
+                        receive_start = wait_for_data(connection)
                         avl_data = connection.recv(4096)  # Adjust buffer size as needed
                         if not avl_data:
                             logging.info("No AVL data received. Closing connection.")
@@ -84,23 +90,38 @@ def start_tcp_server(host='0.0.0.0', port=9025):
 
                         while avl_data:
                             try:
-                                # Parse the AVL packet
+                                # One trace per frame, the receive stage goes to the first frame of the buffer
+                                begin_trace(imei, receive_start)
+                                receive_start = None
+
+                                # Parse the AVL packet (marks the frame stage after the header)
                                 parsed_data, num_of_data_1, num_of_bytes_processed = parse_avl_packet(avl_data)
+                                mark_stage('parse')
                                 #logging.info(f'Parsed AVL Data: {parsed_data}')
 
                                 # Store each parsed record into the device object
                                 if isinstance(parsed_data, list):
+                                    records_for_api = []
                                     for record in parsed_data:
                                         device.add_avl_record(record)
                                         # Remove 'end_position' from the record before sending to the API
                                         record_for_api = {k: v for k, v in record.items() if k != 'end_position'}
-                                        # Send the record to the API
-                                        send_data_to_api(imei, [record_for_api])
+                                        if upstream_batching_enabled():
+                                            records_for_api.append(record_for_api)
+                                        else:
+                                            # Send the record to the API
+                                            send_data_to_api(imei, [record_for_api])
+
+                                    # Send the whole packet as one compressed/columnar batch (opt-in)
+                                    if records_for_api:
+                                        send_batch_to_api(imei, records_for_api)
 
                                 # Construct and send response based on Number of Data (Records)
                                 response = struct.pack('>I', num_of_data_1)
                                 logging.info(f"Sending response: {response}")
                                 connection.sendall(response)  # Send the original packed response
+                                mark_stage('ack')
+                                end_trace()
 
                                 # Remove processed data from avl_data (adjust as necessary)
                                 avl_data = avl_data[num_of_bytes_processed:]